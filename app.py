@@ -1,22 +1,37 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 from langchain_openai import ChatOpenAI
 from exparso import parse_document
+from pdf_services.models import Document
 from pdf_services.pdf_parser import EnhancedPDFParser
+from pdf_services.utils import ensure_dir
+from redis.asyncio import Redis
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
 import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 import aiofiles
 import zipfile
-import io
 from dotenv import load_dotenv
 
 # .envファイルを読み込み
 load_dotenv()
 
-app = FastAPI(title="PDF Parser", description="PDF文書を解析・パースするWebアプリケーション")
+app = FastAPI(
+    title="PDF Parser",
+    description="PDF文書を解析・パースするWebアプリケーション",
+    default_response_class=ORJSONResponse,
+)
 
 # テンプレートと静的ファイルの設定
 templates = Jinja2Templates(directory="templates")
@@ -24,20 +39,188 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # 出力ディレクトリの作成
 OUTPUT_DIR = Path("output")
-OUTPUT_DIR.mkdir(exist_ok=True)
+ensure_dir(OUTPUT_DIR)
 
 # 一時ファイル保存ディレクトリ
 TEMP_DIR = Path("temp")
-TEMP_DIR.mkdir(exist_ok=True)
+ensure_dir(TEMP_DIR)
 
-# セッション管理用の辞書（実際の本番環境ではRedis等を使用）
-sessions = {}
+# アップロードファイルを書き込む際のチャンクサイズ（1 MiB）
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# ZIPに格納する際に再圧縮しない画像形式
+COMPRESSED_IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.webp'}
+
+# セッション管理用のRedisクライアント（ワーカー・Pod間で共有）
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = Redis.from_url(REDIS_URL)
+
+# セッション情報の有効期限（秒）
+SESSION_TTL = 3600
+
+# 解析結果キャッシュの有効期限（秒）
+RESULT_CACHE_TTL = 86400
+
+# 解析に使用するLLMモデル
+LLM_MODEL = "gpt-4o"
+
+# LLMクライアント（HTTP接続プールをリクエスト間で使い回すため一度だけ生成）
+CHAT_LLM = ChatOpenAI(model=LLM_MODEL)
+VISION_LLM = ChatOpenAI(model=LLM_MODEL)
+
+# PDF解析用のプロセス数
+PARSER_POOL_WORKERS = min(os.cpu_count() or 1, 4)
+
+
+def _new_parser_pool() -> ProcessPoolExecutor:
+    """PDF解析用のプロセスプールを作成"""
+    # スレッドが動作中のプロセスをforkするとロックの状態を引き継いでデッドロックする恐れがあるためspawnで起動する
+    return ProcessPoolExecutor(max_workers=PARSER_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+# PDF解析用のプロセスプール（CPU負荷の高い解析処理をイベントループから切り離す）
+PARSER_POOL = _new_parser_pool()
+
+# ワーカープロセス内のイベントループ（非同期LLMクライアントを同じループで使い回すため保持する）
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def save_session(session_id: str, session_data: dict):
+    """セッション情報をRedisに保存"""
+    await redis_client.set(f"sess:{session_id}", json.dumps(session_data, default=str), ex=SESSION_TTL)
+
+
+async def load_session(session_id: str) -> dict:
+    """セッション情報をRedisから取得"""
+    raw = await redis_client.get(f"sess:{session_id}")
+    if raw is None:
+        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+    return json.loads(raw)
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     """メインページを表示"""
     return templates.TemplateResponse("index.html", {"request": request})
 
+async def load_cached_result(cache_key: str) -> Optional[dict]:
+    """解析結果のキャッシュをRedisから取得"""
+    raw = await redis_client.get(cache_key)
+    if raw is None:
+        return None
+    cached = json.loads(raw)
+    # 結果ファイルが削除されている場合はキャッシュを使用しない
+    if not await asyncio.to_thread(Path(cached["session"]["output_file"]).exists):
+        return None
+    return cached
+
+
+def _preview(text: str, length: int) -> str:
+    """先頭から指定文字数のプレビューを作成"""
+    head = text[:length]
+    return head + ("..." if len(text) > length else "")
+
+
+def _write_pages(output_file_path: Path, document) -> None:
+    """解析結果をページごとにテキストファイルへ書き出す"""
+    with open(output_file_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        for page in document.contents:
+            f.write(f"=== ページ {page.page_number} ===\n{page.contents}\n\n")
+
+
+def _get_worker_loop() -> asyncio.AbstractEventLoop:
+    """ワーカープロセス内で使い回すイベントループを取得"""
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+    return _worker_loop
+
+
+def _run_enhanced(pdf_path: str, output_dir: str) -> tuple[Document, dict, bool]:
+    """ワーカープロセスでEnhanced PDF Parserを実行（すべての画像説明を生成できたかもあわせて返す）"""
+    enhanced_parser = EnhancedPDFParser(chat_model=CHAT_LLM, vision_model=VISION_LLM)
+    document = _get_worker_loop().run_until_complete(enhanced_parser.process_pdf(pdf_path, output_dir))
+    file_paths = enhanced_parser.save_results(document, output_dir)
+    complete = enhanced_parser.image_processor.failed_descriptions == 0
+    return document, file_paths, complete
+
+
+def _run_exparso(pdf_path: str):
+    """ワーカープロセスでexparsoパーサーを実行"""
+    return parse_document(
+        path=pdf_path,
+        model=CHAT_LLM,
+    )
+
+
+async def run_in_parser_pool(func, *args):
+    """解析処理をプロセスプールで実行（ワーカーが異常終了した場合はプールを作り直す）"""
+    global PARSER_POOL
+    pool = PARSER_POOL
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        # 壊れたプールを使い続けると以降の解析がすべて失敗するため、新しいプールに差し替える
+        if PARSER_POOL is pool:
+            PARSER_POOL = _new_parser_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+async def run_enhanced_parser(temp_file_path: Path, session_output_dir: Path) -> tuple[dict, str, bool]:
+    """Enhanced PDF Parserで解析し、セッション情報・プレビュー・解析結果が完全かどうかを返す"""
+    try:
+        document, file_paths, complete = await run_in_parser_pool(_run_enhanced, str(temp_file_path), str(session_output_dir))
+        
+        session_data = {
+            "parser_type": "enhanced",
+            "output_file": file_paths["text_file"],
+            "images_dir": file_paths["images_dir"],
+            "filename": f"enhanced_parsed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+            "page_count": document.total_pages,
+            "input_tokens": document.total_input_tokens,
+            "output_tokens": document.total_output_tokens,
+            "created_at": datetime.now().isoformat(),
+            "has_images": len(document.contents[0].images) > 0 if document.contents and document.contents[0].images else False
+        }
+        
+        preview_text = _preview(document.contents[0].contents, 500) if document.contents else ""
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Enhanced Parserでエラーが発生しました: {str(e)}")
+    
+    return session_data, preview_text, complete
+
+
+async def run_exparso_parser(temp_file_path: Path, session_output_dir: Path) -> tuple[dict, str, bool]:
+    """exparsoパーサーで解析し、セッション情報・プレビュー・解析結果が完全かどうかを返す"""
+    try:
+        document = await run_in_parser_pool(_run_exparso, str(temp_file_path))
+        
+        # 結果ファイルを保存（全体の文字列は作らずページごとに書き出す）
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output_filename = f"exparso_parsed_{timestamp}.txt"
+        output_file_path = session_output_dir / output_filename
+        
+        await asyncio.to_thread(_write_pages, output_file_path, document)
+        
+        preview_text = _preview(document.contents[0].contents, 200) if document.contents else ""
+        
+        session_data = {
+            "parser_type": "exparso",
+            "output_file": str(output_file_path),
+            "filename": output_filename,
+            "page_count": len(document.contents),
+            "input_tokens": document.cost.input_token,
+            "output_tokens": document.cost.output_token,
+            "created_at": datetime.now().isoformat(),
+            "has_images": False
+        }
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"exparso Parserでエラーが発生しました: {str(e)}")
+    
+    return session_data, preview_text, True
+
 @app.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
@@ -51,111 +234,66 @@ async def upload_file(
     session_id = str(uuid.uuid4())
     
     try:
-        # 一時ファイルに保存
+        # 一時ファイルに保存（書き込みながら内容のハッシュを計算）
         temp_file_path = TEMP_DIR / f"{session_id}_{file.filename}"
+        content_hash = hashlib.blake2b(digest_size=16)
         async with aiofiles.open(temp_file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-        
-        # 出力ディレクトリを作成
-        session_output_dir = OUTPUT_DIR / session_id
-        session_output_dir.mkdir(exist_ok=True)
-        
-        if parser_type == "enhanced":
-            # Enhanced PDF Parserを使用
-            try:
-                chat_model = ChatOpenAI(model="gpt-4o")
-                vision_model = ChatOpenAI(model="gpt-4o")
-                
-                enhanced_parser = EnhancedPDFParser(chat_model=chat_model, vision_model=vision_model)
-                document = enhanced_parser.process_pdf(str(temp_file_path), str(session_output_dir))
-                file_paths = enhanced_parser.save_results(document, str(session_output_dir))
-                
-                # セッション情報を保存
-                sessions[session_id] = {
-                    "parser_type": "enhanced",
-                    "output_file": file_paths["text_file"],
-                    "images_dir": file_paths["images_dir"],
-                    "filename": f"enhanced_parsed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                    "page_count": document.total_pages,
-                    "input_tokens": document.total_input_tokens,
-                    "output_tokens": document.total_output_tokens,
-                    "created_at": datetime.now(),
-                    "has_images": len(document.contents[0].images) > 0 if document.contents and document.contents[0].images else False
-                }
-                
-                preview_text = document.contents[0].contents[:500] + "..." if document.contents and len(document.contents[0].contents) > 500 else document.contents[0].contents if document.contents else ""
-                
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"Enhanced Parserでエラーが発生しました: {str(e)}")
-            
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                content_hash.update(chunk)
+                await f.write(chunk)
+        
+        # 同じ内容のPDFが解析済みであれば結果を再利用
+        parser_name = "enhanced" if parser_type == "enhanced" else "exparso"
+        cache_key = f"pdfcache:{parser_name}:{LLM_MODEL}:{content_hash.hexdigest()}"
+        cached = await load_cached_result(cache_key)
+        
+        if cached is not None:
+            session_data = cached["session"]
+            session_data["created_at"] = datetime.now().isoformat()
+            preview_text = cached["preview"]
         else:
-            # exparsoパーサーを使用
-            try:
-                llm_model = ChatOpenAI(model="gpt-4o")
-                document = parse_document(
-                    path=str(temp_file_path),
-                    model=llm_model,
+            # 出力ディレクトリを作成
+            session_output_dir = OUTPUT_DIR / session_id
+            ensure_dir(session_output_dir)
+            
+            if parser_name == "enhanced":
+                session_data, preview_text, complete = await run_enhanced_parser(temp_file_path, session_output_dir)
+            else:
+                session_data, preview_text, complete = await run_exparso_parser(temp_file_path, session_output_dir)
+            
+            # 画像説明の生成に失敗した結果をキャッシュすると一時的なエラーが再利用されるため、完全な結果のみ保存
+            if complete:
+                await redis_client.set(
+                    cache_key,
+                    json.dumps({"session": session_data, "preview": preview_text}),
+                    ex=RESULT_CACHE_TTL,
                 )
-                
-                # 結果をテキストとして抽出
-                extracted_text = ""
-                for page in document.contents:
-                    extracted_text += f"=== ページ {page.page_number} ===\n"
-                    extracted_text += page.contents + "\n\n"
-                
-                # 結果ファイルを保存
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                output_filename = f"exparso_parsed_{timestamp}.txt"
-                output_file_path = session_output_dir / output_filename
-                
-                async with aiofiles.open(output_file_path, 'w', encoding='utf-8') as f:
-                    await f.write(extracted_text)
-                
-                # セッション情報を保存
-                sessions[session_id] = {
-                    "parser_type": "exparso",
-                    "output_file": str(output_file_path),
-                    "filename": output_filename,
-                    "page_count": len(document.contents),
-                    "input_tokens": document.cost.input_token,
-                    "output_tokens": document.cost.output_token,
-                    "created_at": datetime.now(),
-                    "has_images": False
-                }
-                
-                preview_text = document.contents[0].contents[:200] + "..." if document.contents and len(document.contents[0].contents) > 200 else document.contents[0].contents if document.contents else ""
-                
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"exparso Parserでエラーが発生しました: {str(e)}")
+        
+        await save_session(session_id, session_data)
         
         # 一時ファイルを削除
-        temp_file_path.unlink()
+        await asyncio.to_thread(temp_file_path.unlink)
         
         return {
             "session_id": session_id,
             "message": f"ファイルの解析が完了しました（{parser_type}パーサー使用）",
             "parser_type": parser_type,
-            "page_count": sessions[session_id]["page_count"],
-            "input_tokens": sessions[session_id]["input_tokens"],
-            "output_tokens": sessions[session_id]["output_tokens"],
-            "has_images": sessions[session_id].get("has_images", False),
+            "page_count": session_data["page_count"],
+            "input_tokens": session_data["input_tokens"],
+            "output_tokens": session_data["output_tokens"],
+            "has_images": session_data.get("has_images", False),
             "preview": preview_text
         }
         
     except Exception as e:
         # エラーが発生した場合、一時ファイルを削除
-        if temp_file_path.exists():
-            temp_file_path.unlink()
+        await asyncio.to_thread(temp_file_path.unlink, missing_ok=True)
         raise HTTPException(status_code=500, detail=f"ファイルの処理中にエラーが発生しました: {str(e)}")
 
 @app.get("/download/{session_id}")
 async def download_file(session_id: str):
     """解析結果をダウンロード"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
-    
-    session_data = sessions[session_id]
+    session_data = await load_session(session_id)
     
     if session_data["parser_type"] == "enhanced":
         # Enhanced Parserの場合、ZIPファイルでダウンロード
@@ -172,21 +310,11 @@ async def download_file(session_id: str):
             media_type='text/plain'
         )
 
-async def download_enhanced_zip(session_id: str, session_data: dict):
-    """Enhanced Parserの結果をZIPファイルでダウンロード"""
-    text_file_path = Path(session_data["output_file"])
-    images_dir_path = Path(session_data["images_dir"])
-    
-    if not text_file_path.exists():
-        raise HTTPException(status_code=404, detail="テキストファイルが見つかりません")
-    
-    # ZIPファイルをメモリ上で作成
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        # テキストファイルを追加
-        with open(text_file_path, 'r', encoding='utf-8') as f:
-            zip_file.writestr(session_data["filename"], f.read())
+def build_enhanced_zip(zip_file_path: Path, text_file_path: Path, images_dir_path: Path, text_filename: str):
+    """Enhanced Parserの結果をZIPファイルに書き出す"""
+    with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_STORED) as zip_file:
+        # テキストファイルを追加（テキストのみ軽量な設定で圧縮）
+        zip_file.write(text_file_path, arcname=text_filename, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
         
         # 画像ディレクトリが存在する場合、画像ファイルを追加
         if images_dir_path.exists():
@@ -194,30 +322,54 @@ async def download_enhanced_zip(session_id: str, session_data: dict):
                 if image_file.is_file():
                     # images/ディレクトリ内に配置
                     arcname = f"images/{image_file.name}"
-                    zip_file.write(image_file, arcname)
+                    # 圧縮済みの画像形式は再圧縮しない
+                    if image_file.suffix.lower() in COMPRESSED_IMAGE_SUFFIXES:
+                        zip_file.write(image_file, arcname, compress_type=zipfile.ZIP_STORED)
+                    else:
+                        zip_file.write(image_file, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+async def download_enhanced_zip(session_id: str, session_data: dict):
+    """Enhanced Parserの結果をZIPファイルでダウンロード"""
+    text_file_path = Path(session_data["output_file"])
+    images_dir_path = Path(session_data["images_dir"])
     
-    zip_buffer.seek(0)
+    if not text_file_path.exists():
+        raise HTTPException(status_code=404, detail="テキストファイルが見つかりません")
+    
+    # ZIPファイルを一時ディレクトリに作成（メモリ上に全体を保持しない）
+    zip_file_path = TEMP_DIR / f"{session_id}_{uuid.uuid4().hex}.zip"
+    try:
+        await asyncio.to_thread(
+            build_enhanced_zip, zip_file_path, text_file_path, images_dir_path, session_data["filename"]
+        )
+    except Exception:
+        await asyncio.to_thread(zip_file_path.unlink, missing_ok=True)
+        raise
     
     # ZIPファイル名を生成
     zip_filename = f"enhanced_parsed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
     
-    # ZIPファイルの内容を取得
-    zip_content = zip_buffer.getvalue()
-    
-    return Response(
-        content=zip_content,
+    # 送信完了後に一時ZIPファイルを削除
+    return FileResponse(
+        path=str(zip_file_path),
+        filename=zip_filename,
         media_type='application/zip',
-        headers={"Content-Disposition": f"attachment; filename={zip_filename}"}
+        background=BackgroundTask(zip_file_path.unlink, missing_ok=True)
     )
 
 @app.get("/status/{session_id}")
 async def get_status(session_id: str):
     """セッションの状態を取得"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
-    
-    return sessions[session_id]
+    return await load_session(session_id)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + 複数ワーカーで起動（セッションはRedisで共有されるためワーカー間で整合する）
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=min(os.cpu_count() or 1, 4),
+        loop="uvloop",
+        http="httptools",
+    )
@@ -3,5 +3,6 @@ Data models for PDF services
 """
 
 from .document import Document, PageContents, Cost
+from .element_table import ElementTable
 
-__all__ = ["Document", "PageContents", "Cost"]
+__all__ = ["Document", "PageContents", "Cost", "ElementTable"]
@@ -6,6 +6,11 @@ from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 
 
+def _image_to_dict(image: Dict[str, Any]) -> Dict[str, Any]:
+    """画像情報をJSONに変換できる辞書に変換（座標などのNumPy配列はリストにする）"""
+    return {key: value.tolist() if hasattr(value, "tolist") else value for key, value in image.items()}
+
+
 @dataclass
 class Cost:
     """コスト情報"""
@@ -50,7 +55,7 @@ class PageContents:
             "page_number": self.page_number
         }
         if self.images:
-            result["images"] = self.images
+            result["images"] = [_image_to_dict(image) for image in self.images]
         return result
 
 
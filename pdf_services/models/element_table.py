@@ -0,0 +1,53 @@
+"""
+Columnar table of PDF elements (images / captions)
+"""
+
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Iterator
+
+import numpy as np
+
+
+@dataclass
+class ElementTable:
+    """画像・キャプション要素を列ごとに保持するテーブル"""
+    ids: List[str] = field(default_factory=list)
+    pages: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+    mids: np.ndarray = field(default_factory=lambda: np.zeros((0, 2), dtype=np.float32))
+    coordinates: List[Optional[np.ndarray]] = field(default_factory=list)
+    paths: List[Optional[str]] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    categories: List[str] = field(default_factory=list)
+    
+    @classmethod
+    def from_rows(cls, rows: List[Dict[str, Any]]) -> "ElementTable":
+        """要素の辞書のリストから作成"""
+        return cls(
+            ids=[row["id"] for row in rows],
+            pages=np.array([row["page_number"] for row in rows]),
+            mids=np.array([row["midpoint"] for row in rows], dtype=np.float32).reshape(-1, 2),
+            coordinates=[row.get("coordinates") for row in rows],
+            paths=[row.get("image_path") for row in rows],
+            texts=[row.get("text", "") for row in rows],
+            categories=[row.get("category", "") for row in rows],
+        )
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        """要素を辞書形式で取得"""
+        page_number = self.pages[index]
+        return {
+            "id": self.ids[index],
+            "page_number": page_number.item() if isinstance(page_number, np.generic) else page_number,
+            "coordinates": self.coordinates[index],
+            "midpoint": self.mids[index],
+            "image_path": self.paths[index],
+            "text": self.texts[index],
+            "category": self.categories[index],
+        }
+    
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self)):
+            yield self[index]
@@ -3,79 +3,129 @@ Enhanced PDF Parser with VLM support
 exparsoのパターンに従って実装
 """
 
+import asyncio
 import os
+from collections import defaultdict
+from functools import lru_cache
 from typing import Optional, List, Dict
 from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_openai import ChatOpenAI
 from ..models.document import Document, PageContents, Cost
 from ..utils.text_utils import TextProcessor
 from ..utils.image_utils import ImageProcessor
+from ..utils.file_utils import ensure_dir
+from ..utils.pdf_utils import PdfContext
+
+
+@lru_cache(maxsize=None)
+def default_chat_model() -> BaseChatModel:
+    """モデル未指定時に使用するチャットモデル（プロセス内で共有）"""
+    return ChatOpenAI(model="gpt-4o")
 
 
 class EnhancedPDFParser:
     """Enhanced PDF Parser with VLM support"""
     
-    def __init__(self, chat_model: Optional[BaseChatModel] = None, vision_model: Optional[BaseChatModel] = None):
+    def __init__(
+        self,
+        chat_model: Optional[BaseChatModel] = None,
+        vision_model: Optional[BaseChatModel] = None,
+        max_concurrency: int = 8,
+        batch_size: int = 8,
+    ):
         """Enhanced PDF Parser の初期化"""
-        self.chat_model = chat_model
-        self.vision_model = vision_model
+        self.chat_model = chat_model if chat_model is not None else default_chat_model()
+        self.vision_model = vision_model if vision_model is not None else default_chat_model()
+        # 同時に処理するページ数の上限（OpenAIのレート制限対策）
+        self.max_concurrency = max_concurrency
+        # 1回のLLM呼び出しでまとめて処理するページ数
+        self.batch_size = batch_size
         
         self.text_processor = TextProcessor(self.chat_model)
         self.image_processor = ImageProcessor(self.vision_model)
     
-    def process_pdf(self, pdf_path: str, output_dir: str = "./output") -> Document:
+    async def process_pdf(self, pdf_path: str, output_dir: str = "./output") -> Document:
         """PDFファイルを完全に処理するメイン関数（ページごとに統合処理）"""
-        os.makedirs(output_dir, exist_ok=True)
+        ensure_dir(output_dir)
         
-        # PDFの基本情報を取得
-        pages_text = self.text_processor.extract_text_by_pages(pdf_path)
+        with PdfContext(pdf_path) as pdf:
+            # レイアウト解析の対象ページの抜き出しはPyMuPDFを使うため、並行実行の前に済ませる
+            layout_target = await asyncio.to_thread(self.image_processor.prepare_layout_target, pdf_path, pdf)
+            
+            # テキストの抽出と画像・キャプションの抽出は互いに独立しているため並行して実行
+            pages_text, (images, captions) = await asyncio.gather(
+                asyncio.to_thread(self.text_processor.extract_text_by_pages, pdf_path, pdf),
+                asyncio.to_thread(self.image_processor.extract_images_and_captions, pdf_path, output_dir, layout_target),
+            )
         total_pages = len(pages_text)
         print(f"PDF has {total_pages} pages")
         
-        # 画像とキャプションを抽出
-        images, captions = self.image_processor.extract_images_and_captions(pdf_path, output_dir)
         matches = self.image_processor.match_figures_to_captions(images, captions)
         
-        # ページごとに統合処理
-        all_page_contents = []
+        # 画像をページ番号ごとに振り分け
+        images_by_page: Dict[int, List[Dict]] = defaultdict(list)
+        for img in images:
+            images_by_page[img["page_number"]].append(img)
+        
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        # 複数ページをまとめてLLMでテキスト処理（バッチ単位で並行実行）
+        batch_tasks = [
+            self._process_text_batch(pages_text[start:start + self.batch_size], start + 1, semaphore)
+            for start in range(0, total_pages, self.batch_size)
+        ]
+        batch_results = await asyncio.gather(*batch_tasks)
+        
+        # ページ順に結果を集約
+        processed_texts: List[str] = []
         total_cost = Cost.zero_cost()
         
-        for page_num, page_text in enumerate(pages_text, 1):
-            print(f"Processing page {page_num}/{total_pages}...")
-            
-            # このページの画像を取得
-            page_images = [img for img in images if img["page_number"] == page_num]
-            
-            # ページの統合処理
-            enhanced_content, page_cost = self._process_single_page(
-                page_text, page_images, page_num
-            )
-            
-            page_contents = PageContents(
-                contents=enhanced_content,
-                page_number=page_num,
-                images=page_images
+        for batch_texts, batch_cost in batch_results:
+            processed_texts.extend(batch_texts)
+            total_cost = total_cost.add_cost(batch_cost)
+        
+        # 画像説明の挿入はページごとに並行実行
+        page_tasks = [
+            self._process_single_page(
+                processed_text,
+                images_by_page.get(page_num, []),
+                page_num,
+                semaphore,
             )
-            
-            all_page_contents.append(page_contents)
-            total_cost = total_cost.add_cost(page_cost)
+            for page_num, processed_text in enumerate(processed_texts, 1)
+        ]
+        all_page_contents = await asyncio.gather(*page_tasks)
         
-        return Document(contents=all_page_contents, cost=total_cost)
+        return Document(contents=list(all_page_contents), cost=total_cost)
+    
+    async def _process_text_batch(
+        self, batch_texts: List[str], start_page: int, semaphore: asyncio.Semaphore
+    ) -> tuple[List[str], Cost]:
+        """複数ページのテキスト処理"""
+        async with semaphore:
+            end_page = start_page + len(batch_texts) - 1
+            print(f"Processing pages {start_page}-{end_page}...")
+            return await self.text_processor.aprocess_pages_with_llm(batch_texts, start_page)
     
-    def _process_single_page(self, page_text: str, page_images: List[Dict], page_num: int) -> tuple[str, Cost]:
+    async def _process_single_page(
+        self, processed_text: str, page_images: List[Dict], page_num: int, semaphore: asyncio.Semaphore
+    ) -> PageContents:
         """単一ページの統合処理"""
-        # テキスト処理
-        processed_text, text_cost = self.text_processor.process_text_with_llm(page_text)
-        
         # 画像説明を適切な場所に挿入
         if page_images:
-            print(f"  Generating image descriptions for page {page_num}...")
-            enhanced_content = self.image_processor.insert_image_descriptions_in_text(
-                processed_text, page_images
-            )
+            async with semaphore:
+                print(f"  Generating image descriptions for page {page_num}...")
+                enhanced_content = await asyncio.to_thread(
+                    self.image_processor.insert_image_descriptions_in_text, processed_text, page_images
+                )
         else:
             enhanced_content = processed_text
         
-        return enhanced_content, text_cost
+        return PageContents(
+            contents=enhanced_content,
+            page_number=page_num,
+            images=page_images
+        )
     
     def save_results(self, document: Document, output_dir: str):
         """結果をファイルに保存"""
@@ -88,7 +138,7 @@ class EnhancedPDFParser:
             all_content.append(page_content.contents)
             all_content.append("")
         
-        with open(output_file_path, 'w', encoding='utf-8') as f:
+        with open(output_file_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
             f.write('\n'.join(all_content))
         
         print(f"pdf parser completed. Total pages: {len(document.contents)}")
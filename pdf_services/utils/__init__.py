@@ -2,7 +2,9 @@
 Utility functions for PDF processing
 """
 
+from .file_utils import DiskCache, ensure_dir
 from .image_utils import ImageProcessor
+from .pdf_utils import PdfContext
 from .text_utils import TextProcessor
 
-__all__ = ["ImageProcessor", "TextProcessor"]
+__all__ = ["DiskCache", "ImageProcessor", "PdfContext", "TextProcessor", "ensure_dir"]
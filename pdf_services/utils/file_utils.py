@@ -0,0 +1,104 @@
+"""
+File system utilities
+"""
+
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1024)
+def _make_dir(path: str) -> None:
+    """ディレクトリを作成（作成済みのパスはキャッシュによりスキップ）"""
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+
+def ensure_dir(path: Union[str, Path]) -> None:
+    """ディレクトリが存在することを保証（プロセス内で一度だけ作成する）"""
+    _make_dir(str(path))
+
+
+@lru_cache(maxsize=None)
+def _prune_cache_dir(cache_dir: Path, max_age: Optional[float], max_entries: Optional[int]) -> None:
+    """期限切れのエントリと、上限を超えた古いエントリを削除（同じ設定のディレクトリはプロセス内で一度だけ）"""
+    if max_age is None and max_entries is None:
+        return
+    try:
+        entries = []
+        for path in cache_dir.glob("*/*.txt"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                continue
+        
+        entries.sort(reverse=True)
+        expired = []
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            expired = [path for mtime, path in entries if mtime < cutoff]
+            entries = [(mtime, path) for mtime, path in entries if mtime >= cutoff]
+        if max_entries is not None:
+            expired.extend(path for _, path in entries[max_entries:])
+        
+        for path in expired:
+            path.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Failed to prune cache directory {cache_dir}: {e}")
+
+
+class DiskCache:
+    """ファイルに保存する文字列キャッシュ（プロセス間で共有可能）
+    
+    読み書きに失敗した場合はキャッシュなしとして扱う。max_ageより古いエントリは無効とし、
+    プロセス内で最初に作成した時にmax_entriesを超えた分を古い順に削除する。
+    """
+    
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        max_age: Optional[float] = 30 * 24 * 3600,
+        max_entries: Optional[int] = 10000,
+    ):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_age = max_age
+        self.max_entries = max_entries
+        # アップロードごとにディレクトリ全体を走査しないよう、削除はプロセス内で一度だけ行う
+        _prune_cache_dir(self.cache_dir, max_age, max_entries)
+    
+    def _path(self, key: str) -> Path:
+        """キーに対応するファイルパス"""
+        return self.cache_dir / key[:2] / f"{key}.txt"
+    
+    def get(self, key: str) -> Optional[str]:
+        """キャッシュされた値を取得（存在しない・期限切れ・読み込めない場合はNone）"""
+        path = self._path(key)
+        try:
+            if self.max_age is not None and time.time() - path.stat().st_mtime > self.max_age:
+                return None
+            return path.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        except (OSError, UnicodeDecodeError) as e:
+            logger.warning(f"Failed to read cache entry {path}: {e}")
+            return None
+    
+    def set(self, key: str, value: str) -> None:
+        """値をキャッシュに保存（一時ファイルに書き込んでから置き換える。失敗しても処理は継続）"""
+        path = self._path(key)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            ensure_dir(path.parent)
+            temp_path.write_text(value, encoding="utf-8")
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to write cache entry {path}: {e}")
+            try:
+                temp_path.unlink(missing_ok=True)
+            except OSError:
+                pass
@@ -5,247 +5,494 @@ Image processing utilities
 import os
 import re
 import base64
+import hashlib
 import io
-from typing import List, Dict, Any, Optional, Tuple
-from PIL import Image
-from langchain_core.prompts import ChatPromptTemplate
+import tempfile
+import threading
+from functools import lru_cache
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple, Union
+import numpy as np
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.language_models.chat_models import BaseChatModel
-from unstructured.partition.pdf import partition_pdf
+from langchain_core.runnables import RunnableLambda
+from ..models.element_table import ElementTable
+from .file_utils import DiskCache, ensure_dir
+from .pdf_utils import PdfContext
+
+
+# 画像のOCRテキスト先頭の図番号・表番号
+_FIG_OR_TABLE_RE = re.compile(r'(fig(?:ure)?|tab(?:le)?)\s*(\d+)', re.IGNORECASE)
+
+# 本文中の図表への参照
+_REF_RE = re.compile(r'(figure|fig|table|図|表)\s*\d+', re.IGNORECASE)
+
+# VLMにそのまま送信できる画像形式（拡張子とMIMEタイプ）
+_PASSTHROUGH_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
+# unstructuredが切り出した画像のファイル名（種類-ページ番号-通し番号）
+_CROP_NAME_RE = re.compile(r'^(figure|table)-(\d+)-(\d+)(\.\w+)$')
+
+# エンコード結果を保持する画像の数（1件あたり数MBになるため、同じ画像の再送に備える程度に留める）
+ENCODED_IMAGE_CACHE_SIZE = 8
+
+
+@lru_cache(maxsize=ENCODED_IMAGE_CACHE_SIZE)
+def _encode_image_file(image_path: str, mtime_ns: int, size: int, max_side: int) -> Tuple[str, str]:
+    """画像ファイルをBase64エンコードしMIMEタイプとともに返す（パス・更新日時・サイズをキーにキャッシュ）"""
+    from PIL import Image
+    
+    with open(image_path, "rb") as f:
+        raw = f.read()
+    
+    # 画像はこの時点ではヘッダーのみ読み込まれる
+    image = Image.open(io.BytesIO(raw))
+    
+    # VLMの入力解像度以下のJPEG・PNGファイルはデコード・再エンコードせずにそのまま使用
+    mime_type = _PASSTHROUGH_MIME_TYPES.get(os.path.splitext(image_path)[1].lower())
+    if mime_type and max(image.size) <= max_side:
+        return base64.b64encode(raw).decode("ascii"), mime_type
+    
+    # 大きな画像はVLMの入力解像度まで縮小
+    image = image.convert("RGB")
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85, optimize=True, progressive=True)
+    return base64.b64encode(buffer.getvalue()).decode("ascii"), "image/jpeg"
+
+
+class LayoutTarget(NamedTuple):
+    """レイアウト解析の対象となるPDF"""
+    # 解析するPDFのパス（画像を含むページがない場合はNone）
+    path: Optional[str]
+    # 解析するPDFのページ番号（1始まり）から元のページ番号への対応（元のPDFをそのまま解析する場合はNone）
+    page_map: Optional[List[int]] = None
 
 
 class ImageProcessor:
     """画像処理ユーティリティ"""
     
-    def __init__(self, vision_model: BaseChatModel):
+    def __init__(
+        self,
+        vision_model: BaseChatModel,
+        max_side: int = 1568,
+        vlm_concurrency: int = 8,
+        description_cache_dir: Optional[str] = "~/.cache/pdf_parser_vlm",
+        hi_res_image_pages_only: bool = True,
+    ):
         self.vision_model = vision_model
+        # VLMに送信する画像の長辺の最大ピクセル数
+        self.max_side = max_side
+        # VLMへの同時リクエスト数の上限（並行して処理する全ページで共有する。ページ単位の並行数とは掛け合わせない）
+        self.vlm_concurrency = vlm_concurrency
+        self._vlm_requests = threading.BoundedSemaphore(vlm_concurrency)
+        # 生成済みの画像説明のキャッシュ（Noneの場合は無効）
+        self.description_cache = DiskCache(description_cache_dir) if description_cache_dir else None
+        # 説明の生成に失敗した画像の数（失敗を含む解析結果をキャッシュしないために参照）
+        self.failed_descriptions = 0
+        self._failed_lock = threading.Lock()
+        # hi_resのレイアウト解析をラスター画像を含むページに限定するか
+        self.hi_res_image_pages_only = hi_res_image_pages_only
     
-    def extract_images_and_captions(self, pdf_path: str, output_dir: str) -> Tuple[List[Dict], List[Dict]]:
-        """画像とキャプションを抽出"""
+    def prepare_layout_target(self, pdf_path: str, pdf: Optional[PdfContext] = None) -> LayoutTarget:
+        """レイアウト解析の対象を決定（画像を含むページだけを抜き出した一時PDFを作成）"""
+        if not self.hi_res_image_pages_only:
+            return LayoutTarget(pdf_path)
+        if pdf is None:
+            with PdfContext(pdf_path) as pdf:
+                return self.prepare_layout_target(pdf_path, pdf)
+        
+        import fitz  # PyMuPDF
+        
+        image_pages = pdf.image_pages
+        if not image_pages:
+            return LayoutTarget(None)
+        if len(image_pages) == pdf.page_count:
+            return LayoutTarget(pdf_path)
         
+        # 共有している文書は変更せず、対象ページを新しい文書に複製する
+        fd, subset_path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            with pdf.lock, fitz.open() as subset:
+                for page_num in image_pages:
+                    subset.insert_pdf(pdf.doc, from_page=page_num, to_page=page_num)
+                subset.save(subset_path)
+        except Exception:
+            os.unlink(subset_path)
+            raise
+        return LayoutTarget(subset_path, [i + 1 for i in image_pages])
+    
+    def extract_images_and_captions(
+        self, pdf_path: str, output_dir: str, target: Optional[LayoutTarget] = None
+    ) -> Tuple[ElementTable, ElementTable]:
+        """画像とキャプションを抽出（targetはprepare_layout_targetで作成したもの。一時PDFは解析後に削除）"""
         # 画像出力ディレクトリを作成
         images_dir = os.path.join(output_dir, "images")
-        os.makedirs(images_dir, exist_ok=True)
-        
-        elements = partition_pdf(
-            filename=pdf_path,
-            strategy="hi_res",
-            extract_images_in_pdf=True,
-            extract_image_block_types=["Image", "Table"],
-            extract_image_block_to_payload=False,
-            extract_image_block_output_dir=images_dir
-        )
+        ensure_dir(images_dir)
+        
+        if target is None:
+            target = self.prepare_layout_target(pdf_path)
+        if target.path is None:
+            return ElementTable.from_rows([]), ElementTable.from_rows([])
+        page_map = target.page_map
+        
+        try:
+            # unstructuredとレイアウト解析モデルの読み込みは重いため、解析対象のページがある場合にのみインポート
+            from unstructured.partition.pdf import partition_pdf
+            
+            elements = partition_pdf(
+                filename=target.path,
+                strategy="hi_res",
+                extract_images_in_pdf=True,
+                extract_image_block_types=["Image", "Table"],
+                extract_image_block_to_payload=False,
+                extract_image_block_output_dir=images_dir
+            )
+        finally:
+            if target.path != pdf_path:
+                os.unlink(target.path)
         
         images = []
         captions = []
         
         for el in elements:
-            if el.category == "Image":
+            md = el.metadata
+            category = el.category
+            text = el.text
+            page_number = md.page_number
+            image_path = getattr(md, "image_path", None)
+            if page_map and page_number:
+                page_number = page_map[page_number - 1]
+                if image_path:
+                    image_path = self._rename_crop_to_page(image_path, page_number)
+            
+            if category == "Image":
+                coordinates, midpoint = self._coordinates_and_midpoint(md.coordinates)
                 images.append({
                     "id": el.id,
-                    "page_number": el.metadata.page_number,
-                    "coordinates": el.metadata.coordinates.points if el.metadata.coordinates else None,
-                    "image_path": el.metadata.image_path if hasattr(el.metadata, 'image_path') else None,
-                    "text": el.text,
-                    "category": el.category
+                    "page_number": page_number,
+                    "coordinates": coordinates,
+                    "midpoint": midpoint,
+                    "image_path": image_path,
+                    "text": text,
+                    "category": category
                 })
-            elif el.category == "FigureCaption" or el.text.lower().startswith(("figure", "fig")):
+            elif category == "FigureCaption" or (text and text.lower().startswith(("figure", "fig"))):
+                coordinates, midpoint = self._coordinates_and_midpoint(md.coordinates)
                 captions.append({
                     "id": el.id,
-                    "page_number": el.metadata.page_number,
-                    "coordinates": el.metadata.coordinates.points if el.metadata.coordinates else None,
-                    "text": el.text,
-                    "category": el.category
+                    "page_number": page_number,
+                    "coordinates": coordinates,
+                    "midpoint": midpoint,
+                    "text": text,
+                    "category": category
                 })
         
-        return images, captions
+        return ElementTable.from_rows(images), ElementTable.from_rows(captions)
+    
+    def _rename_crop_to_page(self, image_path: str, page_number: int) -> str:
+        """抜き出したPDFのページ番号で命名された画像を元のPDFのページ番号の名前に変更"""
+        directory, name = os.path.split(image_path)
+        match = _CROP_NAME_RE.match(name)
+        if not match:
+            return image_path
+        # 通し番号は文書全体で一意のため、ページ番号を置き換えても他の画像と名前は重複しない
+        kind, _, index, ext = match.groups()
+        renamed = os.path.join(directory, f"{kind}-{page_number}-{index}{ext}")
+        if renamed != image_path:
+            os.replace(image_path, renamed)
+        return renamed
+    
+    def _coordinates_and_midpoint(self, coordinates) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """要素の座標を配列に変換し、中心点とあわせて返す"""
+        if not coordinates:
+            return None, np.zeros(2, dtype=np.float32)
+        points = np.asarray(coordinates.points, dtype=np.float32)
+        return points, points.mean(axis=0)
     
     def find_midpoint_from_corners(self, points):
         """四角形の座標から中心点を計算"""
-        if not points:
-            return (0, 0)
-        x_coords = [p[0] for p in points]
-        y_coords = [p[1] for p in points]
-        center_x = sum(x_coords) / len(x_coords)
-        center_y = sum(y_coords) / len(y_coords)
-        return center_x, center_y
+        if points is None or len(points) == 0:
+            return np.zeros(2, dtype=np.float32)
+        return np.asarray(points, dtype=np.float32).mean(axis=0)
     
     def calculate_distance(self, center1, center2):
         """二点間の距離を計算"""
         return ((center1[0] - center2[0]) ** 2 + (center1[1] - center2[1]) ** 2) ** 0.5
     
-    def match_figures_to_captions(self, images: List[Dict], captions: List[Dict]) -> List[Tuple[str, Optional[str]]]:
-        """図とキャプションをマッチング"""
-        matches = []
+    def match_figures_to_captions(
+        self, images: Union[ElementTable, List[Dict]], captions: Union[ElementTable, List[Dict]]
+    ) -> List[Tuple[str, Optional[str]]]:
+        """図とキャプションをマッチング（同じページで図より下にある最も近いキャプション）"""
+        if not isinstance(images, ElementTable):
+            images = ElementTable.from_rows(images)
+        if not isinstance(captions, ElementTable):
+            captions = ElementTable.from_rows(captions)
         
-        for image in images:
-            image_midpoint = self.find_midpoint_from_corners(image["coordinates"])
-            closest_caption = None
-            closest_distance = float('inf')
-            
-            for caption in captions:
-                if (image["page_number"] == caption["page_number"] and 
-                    self.find_midpoint_from_corners(caption["coordinates"])[1] > image_midpoint[1]):
-                    
-                    caption_midpoint = self.find_midpoint_from_corners(caption["coordinates"])
-                    distance = self.calculate_distance(image_midpoint, caption_midpoint)
-                    
-                    if distance < closest_distance:
-                        closest_distance = distance
-                        closest_caption = caption
-            
-            if closest_caption:
-                matches.append((image["id"], closest_caption["id"]))
-            else:
-                matches.append((image["id"], None))
+        if not len(images):
+            return []
+        if not len(captions):
+            return [(image_id, None) for image_id in images.ids]
+        
+        image_mids = images.mids
+        caption_mids = captions.mids
+        
+        # 全ての図とキャプションの組み合わせの距離を一括で計算
+        distances = np.hypot(
+            image_mids[:, None, 0] - caption_mids[None, :, 0],
+            image_mids[:, None, 1] - caption_mids[None, :, 1],
+        )
         
-        return matches
+        # 同じページかつ図より下にあるキャプションのみを候補とする
+        candidates = (images.pages[:, None] == captions.pages[None, :]) & (
+            caption_mids[None, :, 1] > image_mids[:, None, 1]
+        )
+        distances[~candidates] = np.inf
+        
+        closest = distances.argmin(axis=1)
+        matched = np.isfinite(distances[np.arange(len(images)), closest])
+        
+        return [
+            (image_id, captions.ids[index] if found else None)
+            for image_id, index, found in zip(images.ids, closest, matched)
+        ]
+    
+    def build_image_prompt(self, image_path: str, caption: str = "", ocr_text: str = "") -> ChatPromptValue:
+        """画像説明生成用のプロンプトを作成（OCRテキストも活用）"""
+        # キャプション情報をプロンプトに追加
+        caption_context = f"\n\nこの画像のキャプション情報: {caption}" if caption else ""
+        
+        # OCRテキスト情報をプロンプトに追加
+        ocr_context = ""
+        if ocr_text and ocr_text.strip():
+            ocr_context = f"\n\nこの画像からOCRで抽出されたテキスト情報: {ocr_text.strip()}"
+        
+        # VLM用のプロンプト（OCRテキストも活用）
+        system_prompt = (
+            "あなたは画像を説明する専門家です。画像の内容を詳細に日本語で説明してください。"
+            "以下の情報を参考にして、より正確で詳細な説明を提供してください："
+            "1. 画像の実際の視覚的内容"
+            "2. キャプション情報（参考情報として）"
+            "3. OCRで抽出されたテキスト情報（画像内の文字や数値など）"
+            "説明では、OCRで抽出されたテキスト情報も適切に組み込んで、"
+            "画像の内容をより正確に表現してください。"
+        ) + caption_context + ocr_context
+        
+        human_prompt = (
+            "この画像の内容を詳細に説明してください。"
+            "画像内の文字、数値、ラベル、グラフの値など、"
+            "OCRで抽出されたテキスト情報も含めて、"
+            "可能な限り具体的で正確な説明を提供してください。"
+        )
+        
+        # 画像をBase64エンコード
+        encoded_image, mime_type = self._read_and_encode(image_path)
+        
+        # テンプレートを介さずにメッセージを直接組み立てる（Base64文字列をテンプレートとして解析・複製しない）
+        return ChatPromptValue(messages=[
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=[
+                {"type": "text", "text": human_prompt},
+                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}}
+            ])
+        ])
     
     def generate_image_description(self, image_path: str, caption: str = "", ocr_text: str = "") -> str:
         """VLMを使用して画像の説明を生成（OCRテキストも活用）"""
-        if not os.path.exists(image_path):
-            return "画像が見つかりません"
-        
-        try:
-            # 画像を読み込み
-            image = Image.open(image_path)
-            
-            # キャプション情報をプロンプトに追加
-            caption_context = f"\n\nこの画像のキャプション情報: {caption}" if caption else ""
-            
-            # OCRテキスト情報をプロンプトに追加
-            ocr_context = ""
-            if ocr_text and ocr_text.strip():
-                ocr_context = f"\n\nこの画像からOCRで抽出されたテキスト情報: {ocr_text.strip()}"
-            
-            # VLM用のプロンプト（OCRテキストも活用）
-            system_prompt = (
-                "あなたは画像を説明する専門家です。画像の内容を詳細に日本語で説明してください。"
-                "以下の情報を参考にして、より正確で詳細な説明を提供してください："
-                "1. 画像の実際の視覚的内容"
-                "2. キャプション情報（参考情報として）"
-                "3. OCRで抽出されたテキスト情報（画像内の文字や数値など）"
-                "説明では、OCRで抽出されたテキスト情報も適切に組み込んで、"
-                "画像の内容をより正確に表現してください。"
-            ) + caption_context + ocr_context
-            
-            human_prompt = (
-                "この画像の内容を詳細に説明してください。"
-                "画像内の文字、数値、ラベル、グラフの値など、"
-                "OCRで抽出されたテキスト情報も含めて、"
-                "可能な限り具体的で正確な説明を提供してください。"
+        return self.generate_image_descriptions_batch(
+            [{"image_path": image_path, "caption": caption, "ocr_text": ocr_text}]
+        )[0]
+    
+    def generate_image_descriptions_batch(self, jobs: List[Dict]) -> List[str]:
+        """複数画像の説明をVLMへのバッチ呼び出しでまとめて生成"""
+        return self._describe_images(jobs)[0]
+    
+    def _describe_images(self, jobs: List[Dict]) -> Tuple[List[str], List[int]]:
+        """複数画像の説明を生成し、説明と生成に失敗した画像のインデックスを返す"""
+        descriptions, pending, failed = self._prepare_image_prompts(jobs)
+        if pending:
+            responses = RunnableLambda(self._invoke_vision_model).batch(
+                [prompt for _, _, prompt in pending],
+                config={"max_concurrency": self.vlm_concurrency},
+                return_exceptions=True,
             )
-            
-            # 画像をBase64エンコード
-            encoded_image = self._encode_image(image)
-            
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_prompt),
-                ("human", [
-                    {"type": "text", "text": human_prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}}
-                ])
-            ])
-            
-            # VLMで画像説明を生成
-            chain = prompt | self.vision_model
-            response = chain.invoke({})
-            
-            return response.content
-            
-        except Exception as e:
-            print(f"画像説明生成エラー: {e}")
-            return f"画像説明の生成に失敗しました: {str(e)}"
+            failed.extend(self._collect_descriptions(descriptions, pending, responses))
+        return descriptions, failed
+    
+    def _invoke_vision_model(self, prompt: ChatPromptValue) -> BaseMessage:
+        """VLMを呼び出す（同時に実行中のリクエストがvlm_concurrency件に達している場合は空くまで待つ）"""
+        with self._vlm_requests:
+            return self.vision_model.invoke(prompt)
+    
+    def _prepare_image_prompts(
+        self, jobs: List[Dict]
+    ) -> Tuple[List[str], List[Tuple[int, str, ChatPromptValue]], List[int]]:
+        """各画像のプロンプトを作成（キャッシュ済みの画像は説明を、作成できない画像はエラーメッセージを設定）"""
+        descriptions: List[str] = []
+        pending: List[Tuple[int, str, ChatPromptValue]] = []
+        failed: List[int] = []
+        
+        for i, job in enumerate(jobs):
+            descriptions.append("")
+            image_path = job["image_path"]
+            if not os.path.exists(image_path):
+                descriptions[i] = "画像が見つかりません"
+                failed.append(i)
+                continue
+            try:
+                caption = job.get("caption", "")
+                ocr_text = job.get("ocr_text", "")
+                cache_key = ""
+                if self.description_cache:
+                    cache_key = self._description_cache_key(image_path, caption, ocr_text)
+                    cached = self.description_cache.get(cache_key)
+                    if cached is not None:
+                        descriptions[i] = cached
+                        continue
+                
+                prompt = self.build_image_prompt(image_path, caption, ocr_text)
+                pending.append((i, cache_key, prompt))
+            except Exception as e:
+                descriptions[i] = self._description_error(e)
+                failed.append(i)
+        
+        return descriptions, pending, failed
+    
+    def _collect_descriptions(
+        self, descriptions: List[str], pending: List[Tuple[int, str, ChatPromptValue]], responses: List[Any]
+    ) -> List[int]:
+        """VLMの応答を元の画像の順序に戻して設定し、生成に失敗した画像のインデックスを返す"""
+        failed = []
+        for (i, cache_key, _), response in zip(pending, responses):
+            if isinstance(response, Exception):
+                descriptions[i] = self._description_error(response)
+                failed.append(i)
+                continue
+            descriptions[i] = response.content
+            if self.description_cache:
+                self.description_cache.set(cache_key, response.content)
+        return failed
+    
+    def _description_cache_key(self, image_path: str, caption: str, ocr_text: str) -> str:
+        """画像の内容・キャプション・OCRテキスト・モデルから画像説明のキャッシュキーを作成"""
+        model_name = getattr(self.vision_model, "model_name", None) or self.vision_model.__class__.__name__
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            digest.update(f.read())
+        for value in (caption, ocr_text, model_name):
+            digest.update(b"\0")
+            digest.update(value.encode())
+        return digest.hexdigest()
     
-    def _encode_image(self, image: Image.Image) -> str:
-        """画像をBase64エンコード"""
-        buffer = io.BytesIO()
-        image.save(buffer, format="JPEG")
-        img_bytes = buffer.getvalue()
-        return base64.b64encode(img_bytes).decode()
+    def _description_error(self, error: Exception) -> str:
+        """画像説明の生成に失敗した場合のメッセージ"""
+        print(f"画像説明生成エラー: {error}")
+        return f"画像説明の生成に失敗しました: {str(error)}"
+    
+    def _read_and_encode(self, image_path: str) -> Tuple[str, str]:
+        """画像ファイルをBase64エンコードしMIMEタイプとともに返す（変更のないファイルはキャッシュを利用）"""
+        stat = os.stat(image_path)
+        return _encode_image_file(image_path, stat.st_mtime_ns, stat.st_size, self.max_side)
     
     def generate_page_image_descriptions(self, page_images: List[Dict], page_text: str) -> str:
         """指定されたページの画像説明を生成（captionは本文から除外）"""
         if not page_images:
             return ""
         
-        descriptions = []
+        figures = [self._identify_figure(image) for image in page_images]
         
-        for image in page_images:
-            # 画像ファイル名をデフォルトのfigure_nameとして設定
-            image_path = image.get("image_path", "")
-            if image_path:
-                figure_name = os.path.basename(image_path)
-            else:
-                figure_name = "Unknown Figure"
-            
-            figure_type = "Figure"
-            
-            # 画像のOCRテキストから図番号を抽出
-            ocr_text = image.get("text", "")
-            if ocr_text:
-                # Figure判定
-                fig_search = re.search(r'^(fig|figure)\s*(\d+)', ocr_text, re.IGNORECASE)
-                if fig_search:
-                    figure_name = f"Figure {fig_search.group(2)}"
-                    figure_type = "Figure"
-                else:
-                    # Table判定
-                    table_search = re.search(r'^(table|tab)\s*(\d+)', ocr_text, re.IGNORECASE)
-                    if table_search:
-                        figure_name = f"Table {table_search.group(2)}"
-                        figure_type = "Table"
-            
-            # 画像説明を生成（OCRテキストのみ活用、captionは本文に含まれているため除外）
-            image_description = ""
-            if image.get("image_path"):
-                image_description = self.generate_image_description(image["image_path"], "", ocr_text)
-            
-            # 画像情報をフォーマット（captionは除外）
-            img_info = f"[{figure_type}] {figure_name}"
-            
-            if ocr_text and ocr_text.strip():
-                img_info += f"\n[Image Text]: {ocr_text.strip()}"
-            
-            if image.get("image_path"):
-                image_path = image['image_path']
-                if 'images/' in image_path:
-                    image_path = image_path.split('images/')[-1]
-                    image_path = f"images/{image_path}"
-                img_info += f"\n[Image Path]: {image_path}"
-            
-            if image_description:
-                img_info += f"\n[Description]: {image_description}"
-            
-            descriptions.append(img_info)
+        # 画像説明の生成対象（OCRテキストのみ活用、captionは本文に含まれているため除外）
+        jobs = [
+            {"image_path": image["image_path"], "caption": "", "ocr_text": ocr_text}
+            for image, _, _, ocr_text in figures
+            if image.get("image_path")
+        ]
         
-        return "\n\n".join(descriptions)
+        # ページ内の画像説明をまとめて生成（VLMへのHTTP呼び出しは全ページあわせてvlm_concurrency件まで並行）
+        generated_descriptions, failed = self._describe_images(jobs)
+        if failed:
+            with self._failed_lock:
+                self.failed_descriptions += len(failed)
+        generated = iter(generated_descriptions)
+        
+        return "\n\n".join(
+            self._describe_one(image, figure_type, figure_name, ocr_text,
+                               next(generated) if image.get("image_path") else "")
+            for image, figure_type, figure_name, ocr_text in figures
+        )
+    
+    def _identify_figure(self, image: Dict) -> Tuple[Dict, str, str, str]:
+        """画像のOCRテキストから図表の種類と番号を判定"""
+        # 画像ファイル名をデフォルトのfigure_nameとして設定
+        image_path = image.get("image_path", "")
+        if image_path:
+            figure_name = os.path.basename(image_path)
+        else:
+            figure_name = "Unknown Figure"
+        
+        figure_type = "Figure"
+        
+        # 画像のOCRテキストから図番号を抽出
+        ocr_text = image.get("text", "")
+        if ocr_text:
+            # Figure・Table判定（先頭の語で判別）
+            match = _FIG_OR_TABLE_RE.match(ocr_text.lstrip())
+            if match:
+                figure_type = "Figure" if match.group(1)[0] in "fF" else "Table"
+                figure_name = f"{figure_type} {match.group(2)}"
+        
+        return image, figure_type, figure_name, ocr_text
+    
+    def _describe_one(self, image: Dict, figure_type: str, figure_name: str, ocr_text: str, image_description: str) -> str:
+        """1枚の画像の情報をフォーマット（captionは除外）"""
+        parts = [f"[{figure_type}] {figure_name}"]
+        
+        if ocr_text and ocr_text.strip():
+            parts.append(f"[Image Text]: {ocr_text.strip()}")
+        
+        if image.get("image_path"):
+            image_path = image['image_path']
+            if 'images/' in image_path:
+                image_path = image_path.split('images/')[-1]
+                image_path = f"images/{image_path}"
+            parts.append(f"[Image Path]: {image_path}")
+        
+        if image_description:
+            parts.append(f"[Description]: {image_description}")
+        
+        return "\n".join(parts)
     
     def insert_image_descriptions_in_text(self, text: str, page_images: List[Dict]) -> str:
         """テキスト内の適切な場所に画像説明を挿入"""
         if not page_images:
             return text
         
-        lines = text.split('\n')
         enhanced_lines = []
         
-        # 画像情報を準備
-        image_descriptions = self.generate_page_image_descriptions(page_images, text)
+        # 図表参照の後に挿入する画像説明（最初の参照が見つかった時点で一度だけ作成）
+        description_block = None
         
         # テキスト内で図表の参照を検索して挿入
-        i = 0
-        while i < len(lines):
-            line = lines[i]
+        for line in text.split('\n'):
             enhanced_lines.append(line)
             
             # 図表の参照パターンを検索
-            if re.search(r'(figure|fig|table|図|表)\s*\d+', line, re.IGNORECASE):
-                # 図表参照の後に画像説明を挿入
-                enhanced_lines.append(f"\n{image_descriptions}\n")
-            
-            i += 1
+            if _REF_RE.search(line):
+                if description_block is None:
+                    description_block = f"\n{self.generate_page_image_descriptions(page_images, text)}\n"
+                # 図表参照の後に画像説明を挿入（同じ文字列オブジェクトを再利用）
+                enhanced_lines.append(description_block)
         
         # 図表参照が見つからない場合は、ページの最後に追加
-        if not any(re.search(r'(figure|fig|table|図|表)\s*\d+', line, re.IGNORECASE) for line in lines):
+        if description_block is None:
+            image_descriptions = self.generate_page_image_descriptions(page_images, text)
             enhanced_lines.append(f"\n--- Images ---\n{image_descriptions}")
         
         return '\n'.join(enhanced_lines)
@@ -0,0 +1,59 @@
+"""
+PDF document utilities
+"""
+
+import threading
+from functools import cached_property
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    import fitz
+
+# PyMuPDFは別々の文書であってもスレッドから並行して呼び出せないため、プロセス内のすべての呼び出しをこのロックで直列化する
+FITZ_LOCK = threading.RLock()
+
+
+class PdfContext:
+    """PDF文書を一度だけ開き、テキスト抽出と画像抽出で共有するコンテキスト"""
+    
+    def __init__(self, pdf_path: str):
+        self.pdf_path = pdf_path
+        self._doc: Optional["fitz.Document"] = None
+        # 文書へのアクセス時に取得するロック（プロセス内で共通）
+        self.lock = FITZ_LOCK
+    
+    def __enter__(self) -> "PdfContext":
+        import fitz  # PyMuPDF
+        
+        with self.lock:
+            self._doc = fitz.open(self.pdf_path)
+        return self
+    
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+    
+    def close(self) -> None:
+        """文書を閉じる"""
+        if self._doc is not None:
+            with self.lock:
+                self._doc.close()
+            self._doc = None
+    
+    @property
+    def doc(self) -> "fitz.Document":
+        """開いている文書（アクセス時はlockを取得すること）"""
+        if self._doc is None:
+            raise RuntimeError("PdfContext is not open")
+        return self._doc
+    
+    @cached_property
+    def page_count(self) -> int:
+        """ページ数"""
+        with self.lock:
+            return self.doc.page_count
+    
+    @cached_property
+    def image_pages(self) -> List[int]:
+        """ラスター画像を含むページのインデックス（0始まり）"""
+        with self.lock:
+            return [i for i, page in enumerate(self.doc) if page.get_images(full=False)]
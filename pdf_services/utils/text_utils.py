@@ -2,11 +2,65 @@
 Text processing utilities
 """
 
-import fitz  # PyMuPDF
-from typing import Tuple, List
+import asyncio
+import logging
+from functools import lru_cache
+from typing import TYPE_CHECKING, Tuple, List, Optional
+from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import BaseModel, Field
 from ..models.document import Cost
+from .pdf_utils import PdfContext
+
+if TYPE_CHECKING:
+    import fitz
+    import tiktoken
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _get_encoding() -> Optional["tiktoken.Encoding"]:
+    """トークン数の計数に使用するエンコーディング（初回はBPEファイルをダウンロードするため、読み込めない場合はNone）"""
+    try:
+        import tiktoken
+        
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Failed to load tiktoken encoding, token counts will be reported as 0: {e}")
+        return None
+
+
+def _count_tokens(text: str) -> int:
+    """テキストのトークン数を計数（エンコーディングを読み込めない場合は0）"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return 0
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=None)
+def _text_extract_flags() -> int:
+    """テキスト抽出のフラグ（合字・空白文字の保持を省略。後段のLLMで本文を整形するため不要）"""
+    import fitz  # PyMuPDF
+    
+    return fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES & ~fitz.TEXT_PRESERVE_WHITESPACE
+
+
+def _extract_pages_text(doc: "fitz.Document", start: int, stop: int) -> List[str]:
+    """開いている文書の指定範囲のページからテキストを抽出"""
+    flags = _text_extract_flags()
+    return [doc.load_page(page_num).get_text("text", flags=flags) for page_num in range(start, stop)]
+
+
+class _ProcessedPage(BaseModel):
+    page_number: int = Field(description="ページ番号")
+    text: str = Field(description="処理済みの本文")
+
+
+class _ProcessedPages(BaseModel):
+    pages: List[_ProcessedPage] = Field(description="ページごとの処理結果")
 
 
 class TextProcessor:
@@ -16,22 +70,19 @@ class TextProcessor:
         self.chat_model = chat_model
     
     
-    def extract_text_by_pages(self, pdf_path: str) -> List[str]:
-        """PDFファイルからページごとにテキストを抽出"""
-        doc = fitz.open(pdf_path)
-        pages_text = []
-        
-        for page_num in range(doc.page_count):
-            page = doc.load_page(page_num)
-            page_text = page.get_text()
-            pages_text.append(page_text)
+    def extract_text_by_pages(self, pdf_path: str, pdf: Optional[PdfContext] = None) -> List[str]:
+        """PDFファイルからページごとにテキストを抽出（pdfを渡した場合は開いている文書を再利用）"""
+        if pdf is None:
+            with PdfContext(pdf_path) as pdf:
+                return self.extract_text_by_pages(pdf_path, pdf)
         
-        doc.close()
-        return pages_text
+        # 抽出はページあたり数ミリ秒で終わるため、プロセスを起動せずに逐次抽出する
+        with pdf.lock:
+            return _extract_pages_text(pdf.doc, 0, pdf.doc.page_count)
     
     
-    def process_text_with_llm(self, text: str) -> Tuple[str, Cost]:
-        """LLMでテキストを処理"""
+    def _build_prompt(self) -> ChatPromptTemplate:
+        """テキスト処理用のプロンプトを作成"""
         system_prompt = (
             "あなたは優秀な文書処理専門家です。"
             "入力されるテキストはPDFから本文を抽出したものです。"
@@ -40,16 +91,78 @@ class TextProcessor:
             "出力は処理済みの本文のみとし、説明は不要です。"
         )
         
-        prompt = ChatPromptTemplate.from_messages([
+        return ChatPromptTemplate.from_messages([
             ("system", system_prompt),
             ("human", "{text}")
         ])
-        
-        chain = prompt | self.chat_model
+    
+    def process_text_with_llm(self, text: str) -> Tuple[str, Cost]:
+        """LLMでテキストを処理"""
+        chain = self._build_prompt() | self.chat_model
         response = chain.invoke({"text": text})
         
-        # トークン数を取得（簡易版）
-        input_tokens = len(text.split()) * 1.3  # 概算
-        output_tokens = len(response.content.split()) * 1.3
+        return response.content, self._response_cost(response, text, response.content)
+    
+    async def aprocess_text_with_llm(self, text: str) -> Tuple[str, Cost]:
+        """LLMでテキストを処理（非同期版）"""
+        chain = self._build_prompt() | self.chat_model
+        response = await chain.ainvoke({"text": text})
+        
+        return response.content, self._response_cost(response, text, response.content)
+    
+    def _build_batch_prompt(self) -> ChatPromptTemplate:
+        """複数ページをまとめて処理するためのプロンプトを作成"""
+        system_prompt = (
+            "あなたは優秀な文書処理専門家です。"
+            "入力されるテキストはPDFから複数ページ分の本文を抽出したもので、"
+            "各ページは「=== Page ページ番号 ===」で区切られています。"
+            "本文には内容が崩れている箇所などがあるため、ページごとに適宜修正してください。"
+            "ヘッダー、フッターは削除し、可能な限り内容は保持してください。"
+            "ページ同士を結合・分割せず、入力されたすべてのページについてページ番号と処理済みの本文を返してください。"
+        )
+        
+        return ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            ("human", "{pages}")
+        ])
+    
+    async def aprocess_pages_with_llm(self, texts: List[str], start_page: int = 1) -> Tuple[List[str], Cost]:
+        """複数ページのテキストを1回のLLM呼び出しでまとめて処理（非同期版）"""
+        pages = "\n\n".join(
+            f"=== Page {page_num} ===\n{text}" for page_num, text in enumerate(texts, start_page)
+        )
+        
+        structured_model = self.chat_model.with_structured_output(_ProcessedPages, include_raw=True)
+        chain = self._build_batch_prompt() | structured_model
+        result = await chain.ainvoke({"pages": pages})
+        
+        parsed = result["parsed"]
+        if parsed is None:
+            # 出力トークンの上限で応答が途切れた場合などは構造化出力の解析に失敗する
+            logger.warning(
+                f"Failed to parse batch output for pages {start_page}-{start_page + len(texts) - 1}: "
+                f"{result.get('parsing_error')}"
+            )
+        processed = {page.page_number: page.text for page in parsed.pages} if parsed else {}
+        cost = self._response_cost(result["raw"], pages, "\n".join(processed.values()))
+        
+        # 応答に含まれないページは1ページずつ処理し直す
+        outputs = [processed.get(page_num) for page_num in range(start_page, start_page + len(texts))]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        retried = await asyncio.gather(*(self.aprocess_text_with_llm(texts[i]) for i in missing))
+        for i, (output, retry_cost) in zip(missing, retried):
+            outputs[i] = output
+            cost = cost.add_cost(retry_cost)
+        
+        return outputs, cost
+    
+    def _response_cost(self, response: BaseMessage, text: str, output: str) -> Cost:
+        """LLMの応答に含まれるトークン使用量からコストを取得"""
+        usage = getattr(response, "usage_metadata", None) or response.response_metadata.get("token_usage", {})
+        if not usage:
+            # 使用量が返されないモデルの場合はトークナイザーで計数
+            return Cost(_count_tokens(text), _count_tokens(output))
         
-        return response.content, Cost(int(input_tokens), int(output_tokens))
+        input_tokens = usage.get("input_tokens") or usage.get("prompt_tokens") or 0
+        output_tokens = usage.get("output_tokens") or usage.get("completion_tokens") or 0
+        return Cost(input_tokens, output_tokens)
@@ -0,0 +1,55 @@
+import asyncio
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from pdf_services.utils.text_utils import TextProcessor, _ProcessedPage, _ProcessedPages
+
+
+def _usage(input_tokens: int, output_tokens: int) -> dict:
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+
+class _FakeChatModel(RunnableLambda):
+    """ページ単位の呼び出しでは本文に接頭辞を付け、バッチ呼び出しでは指定した結果を返すモデル"""
+
+    def __init__(self, batch_result: dict):
+        super().__init__(self._clean)
+        self.batch_result = batch_result
+        self.page_calls = 0
+
+    def _clean(self, prompt) -> AIMessage:
+        self.page_calls += 1
+        return AIMessage(content=f"cleaned: {prompt.messages[-1].content}", usage_metadata=_usage(10, 5))
+
+    def with_structured_output(self, schema, include_raw: bool = False):
+        return RunnableLambda(lambda _: self.batch_result)
+
+
+def test_unparsed_batch_falls_back_to_single_pages():
+    model = _FakeChatModel({
+        "raw": AIMessage(content="", usage_metadata=_usage(100, 50)),
+        "parsed": None,
+        "parsing_error": ValueError("truncated output"),
+    })
+
+    outputs, cost = asyncio.run(TextProcessor(model).aprocess_pages_with_llm(["page a", "page b"], start_page=3))
+
+    assert outputs == ["cleaned: page a", "cleaned: page b"]
+    assert model.page_calls == 2
+    # バッチ呼び出しで消費したトークンも計上する
+    assert (cost.input_token, cost.output_token) == (120, 60)
+
+
+def test_pages_missing_from_batch_are_retried():
+    model = _FakeChatModel({
+        "raw": AIMessage(content="", usage_metadata=_usage(100, 50)),
+        "parsed": _ProcessedPages(pages=[_ProcessedPage(page_number=1, text="batched a")]),
+        "parsing_error": None,
+    })
+
+    outputs, cost = asyncio.run(TextProcessor(model).aprocess_pages_with_llm(["page a", "page b"]))
+
+    assert outputs == ["batched a", "cleaned: page b"]
+    assert model.page_calls == 1
+    assert (cost.input_token, cost.output_token) == (110, 55)